@@ -135,6 +135,10 @@ def run(fpets, fmris, tracer='pib', flip_pet=None, bias_corr=True, voxsz: int =
     # -------------------------------------------------------------
     # > get the CL masks
     fmasks, masks = load_masks(cl_masks_fldr, voxsz=voxsz)
+
+    # > binary CL masks as flat voxel indices, so that the mean values of
+    # > the VOIs are obtained from the mask voxels only of each PET image
+    msk_idx = {fmsk: np.flatnonzero(masks[fmsk] > 0) for fmsk in fmasks}
     # -------------------------------------------------------------
 
     log.info('iterate through all the input data...')
@@ -256,7 +260,10 @@ def run(fpets, fmris, tracer='pib', flip_pet=None, bias_corr=True, voxsz: int =
         # npet[npet<0] = 0
 
         # > extract mean values and SUVr
-        out[onm]['avgvoi'] = avgvoi = {fmsk: np.mean(npet[masks[fmsk] > 0]) for fmsk in fmasks}
+        npet_flat = npet.ravel()
+        out[onm]['avgvoi'] = avgvoi = {
+            fmsk: npet_flat[msk_idx[fmsk]].sum(dtype=np.float64) / msk_idx[fmsk].size
+            for fmsk in fmasks}
         out[onm]['suvr'] = suvr = {
             fmsk: avgvoi['ctx'] / avgvoi[fmsk]
             for fmsk in fmasks if fmsk != 'ctx'}
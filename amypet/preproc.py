@@ -6,9 +6,10 @@ __author__ = "Pawel Markiewicz"
 __copyright__ = "Copyright 2022"
 
 import logging as log
+import multiprocessing
 import os
 import shutil
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
 from pathlib import Path
 from subprocess import run
@@ -20,6 +21,7 @@ from niftypet import nimpa
 
 from .aux import get_atlas
 from .suvr_tools import r_trimup
+from .utils import cpu_count
 
 log.basicConfig(level=log.WARNING, format=nimpa.LOG_FORMAT)
 
@@ -38,6 +40,10 @@ tracer_names = {
     'flute': ['flt', 'flut', 'flute', 'flutemetamol'], 'fbb': ['fbb', 'florbetaben'],
     'fbp': ['fbp', 'florbetapir']}
 
+# > (alias, tracer) pairs with the longest aliases first for matching
+_tracer_aliases = sorted(((n, t) for t in tracer_names for n in tracer_names[t]),
+                         key=lambda a: len(a[0]), reverse=True)
+
 # > break time for coffee break protocol (target)
 break_time = 1800
 
@@ -56,6 +62,8 @@ def explore_input(
     tracer=None,
     suvr_win_def=None,
     outpath=None,
+    nii_convert=True,
+    nii_force=False,
 ):
     '''
     Process the input folder of amyloid PET DICOM data.
@@ -65,7 +73,8 @@ def explore_input(
     Those files can also be within a subfolder.
 
     Return the dictionary of (1) the list of dictionaries for each DICOM folder
-    (2) list of descriptions for each DICOM folder for classification of input
+    (2) list of descriptions for each DICOM folder for classification of input;
+    the series entries also include the converted NIfTI files (`fnii`)
 
     Arguments:
     - tracer:   The name of one of the three tracers: 'flute', 'fbb', 'fbp'
@@ -76,6 +85,10 @@ def explore_input(
                 defined in`defs.py`)
     - outpath:  output path where all the intermediate and final results are
                 stored.
+    - nii_convert: if True, converts the DICOM series to NIfTI files, each
+                series into its own subfolder of `<outpath>/NIfTI`.
+    - nii_force: if True, converts the series again even if converted NIfTI
+                files already exist.
 
     '''
 
@@ -123,20 +136,29 @@ def explore_input(
 
         msrs_t.append(srs_t)
 
+        # > the time-sorted series keys
+        srs_keys = list(srs_t)
+
         # -----------------------------------------------
         # > frame timings relative to the injection time -
         #   radiopharmaceutical administration start time
-        t_frms = []
+        # > acquisition date/time stamps ('%Y%m%d' + '%H%M%S') in ISO format
+        t_acq = []
         for k in srs_t:
-            t0 = datetime.strptime(srs_t[k]['dstudy'] + srs_t[k]['tacq'],
-                                   '%Y%m%d%H%M%S') - srs_t[k]['radio_start_time']
-            t1 = datetime.strptime(
-                srs_t[k]['dstudy'] + srs_t[k]['tacq'],
-                '%Y%m%d%H%M%S') + srs_t[k]['frm_dur'] - srs_t[k]['radio_start_time']
-            t_frms.append((t0.seconds, t1.seconds))
+            dst, tac = srs_t[k]['dstudy'], srs_t[k]['tacq']
+            t_acq.append(f'{dst[:4]}-{dst[4:6]}-{dst[6:8]}T{tac[:2]}:{tac[2:4]}:{tac[4:6]}')
+        t_acq = np.array(t_acq, dtype='datetime64[us]')
+        t_inj = np.array([srs_t[k]['radio_start_time'] for k in srs_t], dtype='datetime64[us]')
+        t_dur = np.array([srs_t[k]['frm_dur'] for k in srs_t], dtype='timedelta64[us]')
+
+        # > whole seconds within a day (as in `timedelta.seconds`)
+        t0 = (t_acq - t_inj) // np.timedelta64(1, 's') % 86400
+        t1 = (t_acq + t_dur - t_inj) // np.timedelta64(1, 's') % 86400
+        t_frms = list(zip(t0.tolist(), t1.tolist()))
 
-        t_starts = [t[0] for t in t_frms]
-        t_stops = [t[1] for t in t_frms]
+        # > frame start and stop times (arrays)
+        t_starts = t0
+        t_stops = t1
 
         # > overall acquisition duration
         acq_dur = t_frms[-1][-1] - t_frms[0][0]
@@ -158,10 +180,10 @@ def explore_input(
         if tracer is None:
             if 'tracer' in srs_t[next(iter(srs_t))]:
                 tracer_dcm = srs_t[next(iter(srs_t))]['tracer'].lower()
-                for t in tracer_names:
-                    for n in tracer_names[t]:
-                        if n in tracer_dcm:
-                            tracer = t
+                for n, t in _tracer_aliases:
+                    if n in tracer_dcm:
+                        tracer = t
+                        break
 
             # > when tracer info not provided and not in DICOMs
             if acq_type == 'static' and not tracer:
@@ -197,51 +219,114 @@ def explore_input(
             if t_frms[0][
                     0] < suvr_win[0] + mrgn_suvr and acq_dur > suvr_twindow[tracer][2] - mrgn_suvr:
 
-                t0_suvr = min(t_starts, key=lambda x: abs(x - suvr_win[0]))
-                t1_suvr = min(t_stops, key=lambda x: abs(x - suvr_win[1]))
+                # > frames closest to the SUVr window
+                frm_0 = int(np.argmin(np.abs(t_starts - suvr_win[0])))
+                frm_1 = int(np.argmin(np.abs(t_stops - suvr_win[1])))
 
-                frm_0 = t_starts.index(t0_suvr)
-                frm_1 = t_stops.index(t1_suvr)
+                t0_suvr = t_frms[frm_0][0]
+                t1_suvr = t_frms[frm_1][1]
 
                 msrs_class.append({
                     'acq': [acq_type, 'suvr'], 'time': (t0_suvr, t1_suvr), 'timings': t_frms,
                     'idxs': (frm_0, frm_1),
-                    'frms': [s for i, s in enumerate(srs_t) if i in range(frm_0, frm_1 + 1)]})
+                    'frms': srs_keys[frm_0:frm_1 + 1]})
             else:
                 log.warning('The acquisition does not cover the requested time frame!')
 
                 msrs_class.append({
-                    'acq': [acq_type], 'time': (t_starts[0], t_stops[-1]),
-                    'idxs': (0, len(t_frms) - 1), 'frms': [s for i, s in enumerate(srs_t)]})
+                    'acq': [acq_type], 'time': (t_frms[0][0], t_frms[-1][-1]),
+                    'idxs': (0, len(t_frms) - 1), 'frms': srs_keys})
         # -----------------------------------------------
         elif acq_type == 'breakdyn':
-            t0_dyn = min(t_starts, key=lambda x: abs(x - 0))
-            t1_dyn = min(t_stops, key=lambda x: abs(x - break_time))
+            frm_0 = int(np.argmin(np.abs(t_starts - 0)))
+            frm_1 = int(np.argmin(np.abs(t_stops - break_time)))
 
-            frm_0 = t_starts.index(t0_dyn)
-            frm_1 = t_stops.index(t1_dyn)
+            t0_dyn = t_frms[frm_0][0]
+            t1_dyn = t_frms[frm_1][1]
 
             msrs_class.append({
                 'acq': [acq_type], 'time': (t0_dyn, t1_dyn), 'timings': t_frms,
                 'idxs': (frm_0, frm_1),
-                'frms': [s for i, s in enumerate(srs_t) if i in range(frm_0, frm_1 + 1)]})
+                'frms': srs_keys[frm_0:frm_1 + 1]})
         # -----------------------------------------------
         elif acq_type == 'fulldyn':
-            t0_dyn = min(t_starts, key=lambda x: abs(x - 0))
-            t1_dyn = min(t_stops, key=lambda x: abs(x - fulldyn_time))
+            frm_0 = int(np.argmin(np.abs(t_starts - 0)))
+            frm_1 = int(np.argmin(np.abs(t_stops - fulldyn_time)))
 
-            frm_0 = t_starts.index(t0_dyn)
-            frm_1 = t_stops.index(t1_dyn)
+            t0_dyn = t_frms[frm_0][0]
+            t1_dyn = t_frms[frm_1][1]
 
             msrs_class.append({
                 'acq': [acq_type], 'time': (t0_dyn, t1_dyn), 'timings': t_frms,
                 'idxs': (frm_0, frm_1),
-                'frms': [s for i, s in enumerate(srs_t) if i in range(frm_0, frm_1 + 1)]})
+                'frms': srs_keys[frm_0:frm_1 + 1]})
         # -----------------------------------------------
 
+    # ================================================
+    # > convert the DICOM series to NIfTI in one batch, running dcm2niix once
+    # > for each DICOM folder not converted yet; the NIfTI files are recorded
+    # > in the series dictionaries for the later processing stages
+    if nii_convert:
+        niidir = amyout / 'NIfTI'
+
+        def get_niifldr(dfldr):
+            # > one NIfTI subfolder per DICOM (series) folder
+            try:
+                return niidir / '_'.join(dfldr.relative_to(amyout).parts)
+            except ValueError:
+                return niidir / dfldr.name
+
+        def get_fnii(srs_frm):
+            niifldr = get_niifldr(srs_frm['files'][0].parent)
+            return list(niifldr.glob(str(srs_frm['tacq']) + '*.nii*'))
+
+        dcm_fldrs = {
+            srs_t[k]['files'][0].parent
+            for srs_t in msrs_t for k in srs_t if nii_force or len(get_fnii(srs_t[k])) != 1}
+        for dfldr in dcm_fldrs:
+            niifldr = get_niifldr(dfldr)
+            # > no stale files from previous conversions
+            if niifldr.is_dir():
+                shutil.rmtree(niifldr)
+            nimpa.create_dir(niifldr)
+            run([dcm2niix.bin, '-i', 'y', '-v', 'n', '-o', niifldr, 'f', '%f_%s', dfldr])
+
+        for srs_t in msrs_t:
+            for k in srs_t:
+                fnii = get_fnii(srs_t[k])
+                if len(fnii) == 1:
+                    srs_t[k]['fnii'] = fnii[0]
+                else:
+                    log.warning(f'Unexpected number of converted NIfTI files for {k}')
+    # ================================================
+
     return {'series': msrs_t, 'descr': msrs_class, 'outpath': amyout}
 
 
+# =====================================================================
+def _coreg_frames(frm0, frm1, fnii0, fnii1, outpath, reg_fwhm=8, reg_costfun='nmi'):
+    '''
+    Register frame `frm1` (floating, file `fnii1`) to frame `frm0`
+    (reference, file `fnii0`) using SPM.
+
+    Return the frame indices, the path to the affine file, the affine
+    and the motion metric (combined norm of rotations and translations).
+    '''
+
+    log.info(f'registration of frame #{frm1} to frame #{frm0}')
+
+    nimpa.create_dir(outpath)
+    spm_res = nimpa.coreg_spm(fnii0, fnii1, fwhm_ref=reg_fwhm, fwhm_flo=reg_fwhm, fwhm=[13, 13],
+                              costfun=reg_costfun, fcomment=f'_combi_{frm0}-{frm1}',
+                              outpath=outpath, visual=0, save_arr=False, del_uncmpr=True)
+
+    # > motion metric as the norm of rotations (in degrees) and translations (in mm)
+    metric = np.linalg.norm(
+        np.concatenate([180 * spm_res['rotations'] / np.pi, spm_res['translations']]))
+
+    return frm0, frm1, spm_res['faff'], spm_res['affine'], metric
+
+
 # =====================================================================
 def align_suvr(
     suvr_tdata,
@@ -250,6 +335,8 @@ def align_suvr(
     reg_costfun='nmi',
     reg_force=False,
     reg_fwhm=8,
+    reg_scheme='star',
+    parallel=False,
 ):
     '''
     Align SUVr frames after conversion to NIfTI format.
@@ -257,12 +344,23 @@ def align_suvr(
     Arguments:
     - reg_constfun: the cost function used in SPM registration/alignment of frames
     - reg_force:    force running the registration even if the registration results
-                are already calculated and stored in the output folder.
+                are already calculated and stored in the output folder; the
+                frames are then also converted to NIfTI again.
     - reg_fwhm: the FWHM of the Gaussian kernel used for smoothing the images before
                 registration and only for registration purposes.
+    - reg_scheme: 'star' registers all frames to the middle frame (N-1 registrations);
+                'pairwise' registers all frame pairs and picks the reference
+                frame with the least motion (N(N-1)/2 registrations, with
+                the other way transformations obtained by inversion).
+    - parallel: run the independent SPM frame registrations concurrently in
+                separate processes, each with its own MATLAB engine and its
+                own output folder for the registration files.
 
     '''
 
+    if reg_scheme not in ('star', 'pairwise'):
+        raise ValueError(f'unrecognised registration scheme: {reg_scheme}')
+
     if outpath is None:
         align_out = suvr_tdata[next(iter(suvr_tdata))]['files'][0].parent.parent
     else:
@@ -274,7 +372,6 @@ def align_suvr(
 
     # > folder of resampled and aligned NIfTI files (SPM)
     rsmpl_opth = niidir / 'SPM-aligned'
-    nimpa.create_dir(rsmpl_opth)
 
     # > the name of the output re-aligned file name
     faligned = 'SUVr_aligned_' + nimpa.rem_chars(suvr_tdata[next(
@@ -295,16 +392,27 @@ def align_suvr(
             else:
                 shutil.rmtree(f)
 
+        # > (re)create the folder of resampled and aligned files after the clean-up
+        nimpa.create_dir(rsmpl_opth)
+
         # > output nifty frame files
         nii_frms = []
 
         # -----------------------------------------------
-        # > convert the individual DICOM frames to NIfTI
-        for i, k in enumerate(suvr_descr['frms']):
+        # > convert the DICOM frames to NIfTI (unless already converted in
+        # > `explore_input` and not forced), once for each DICOM folder as
+        # > frames can share the same folder
+        use_fnii = {k: not reg_force and 'fnii' in suvr_tdata[k] for k in suvr_descr['frms']}
+        dcm_fldrs = {
+            suvr_tdata[k]['files'][0].parent
+            for k in suvr_descr['frms'] if not use_fnii[k]}
+        for dfldr in dcm_fldrs:
+            run([dcm2niix.bin, '-i', 'y', '-v', 'n', '-o', niidir, 'f', '%f_%s', dfldr])
 
-            run([
-                dcm2niix.bin, '-i', 'y', '-v', 'n', '-o', niidir, 'f', '%f_%s',
-                suvr_tdata[k]['files'][0].parent])
+        for i, k in enumerate(suvr_descr['frms']):
+            if use_fnii[k]:
+                nii_frms.append(Path(suvr_tdata[k]['fnii']))
+                continue
 
             # > get the converted NIfTI file
             fnii = list(niidir.glob(str(suvr_tdata[k]['tacq']) + '*.nii*'))
@@ -323,81 +431,120 @@ def align_suvr(
         # > paths to the affine files
         S = [[None for _ in range(len(nii_frms))] for _ in range(len(nii_frms))]
 
-        # > go through all possible combinations of frame registration
-        for c in combinations(suvr_descr['frms'], 2):
-            frm0 = suvr_descr['frms'].index(c[0])
-            frm1 = suvr_descr['frms'].index(c[1])
-
-            fnii0 = nii_frms[frm0]
-            fnii1 = nii_frms[frm1]
-
-            log.info(f'registration of frame #{frm0} and frame #{frm1}')
+        # > pairs of (reference, floating) frames to be registered
+        if reg_scheme == 'star':
+            # > reference frame for SUVr composite frame
+            rfrm = len(nii_frms) // 2
 
-            # > one way registration
-            spm_res = nimpa.coreg_spm(fnii0, fnii1, fwhm_ref=reg_fwhm, fwhm_flo=reg_fwhm,
-                                      fwhm=[13, 13], costfun=reg_costfun,
-                                      fcomment=f'_combi_{frm0}-{frm1}', outpath=fnii0.parent,
-                                      visual=0, save_arr=False, del_uncmpr=True)
+            # > register all the other frames to the reference frame
+            frm_pairs = [(rfrm, ifrm) for ifrm in range(len(nii_frms)) if ifrm != rfrm]
 
-            S[frm0][frm1] = spm_res['faff']
-
-            rot_ss = np.sum((180 * spm_res['rotations'] / np.pi)**2)**.5
-            trn_ss = np.sum(spm_res['translations']**2)**.5
-            R[frm0, frm1] = rot_ss + trn_ss
-
-            # > the other way registration
-            spm_res = nimpa.coreg_spm(fnii1, fnii0, fwhm_ref=reg_fwhm, fwhm_flo=reg_fwhm,
-                                      fwhm=[13, 13], costfun=reg_costfun,
-                                      fcomment=f'_combi_{frm1}-{frm0}', outpath=fnii0.parent,
-                                      visual=0, save_arr=False, del_uncmpr=True)
+        else:
+            # > go through all possible combinations of frame registration
+            frm_pairs = list(combinations(range(len(nii_frms)), 2))
+
+        # > the SPM registrations are independent of each other; the MATLAB
+        # > engine is one per process, hence separate (spawned) processes,
+        # > each pair having a private folder for the decompressed inputs
+        if parallel and len(frm_pairs) > 1:
+            with ProcessPoolExecutor(max_workers=min(cpu_count(), len(frm_pairs)),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [
+                    executor.submit(_coreg_frames, frm0, frm1, nii_frms[frm0], nii_frms[frm1],
+                                    outpath=niidir / f'reg_{frm0}-{frm1}', reg_fwhm=reg_fwhm,
+                                    reg_costfun=reg_costfun) for frm0, frm1 in frm_pairs]
+                reg_res = [f.result() for f in futures]
+        else:
+            reg_res = [
+                _coreg_frames(frm0, frm1, nii_frms[frm0], nii_frms[frm1], outpath=niidir,
+                              reg_fwhm=reg_fwhm, reg_costfun=reg_costfun)
+                for frm0, frm1 in frm_pairs]
 
-            S[frm1][frm0] = spm_res['faff']
+        for frm0, frm1, faff, aff, metric in reg_res:
+            S[frm0][frm1] = faff
+            R[frm0, frm1] = metric
 
-            rot_ss = np.sum((180 * spm_res['rotations'] / np.pi)**2)**.5
-            trn_ss = np.sum(spm_res['translations']**2)**.5
-            R[frm1, frm0] = rot_ss + trn_ss
+            if reg_scheme == 'pairwise':
+                # > the other way registration from the inverse affine
+                faff_inv = niidir / f'affine-spm_combi_{frm1}-{frm0}_inv.txt'
+                np.savetxt(faff_inv, np.linalg.inv(aff))
+                S[frm1][frm0] = str(faff_inv)
+                R[frm1, frm0] = metric
 
-        # > sum frames along floating frames
-        fsum = np.sum(R, axis=0)
+        if reg_scheme == 'pairwise':
+            # > sum frames along floating frames
+            fsum = np.sum(R, axis=0)
 
-        # > sum frames along reference frames
-        rsum = np.sum(R, axis=1)
+            # > sum frames along reference frames
+            rsum = np.sum(R, axis=1)
 
-        # > reference frame for SUVr composite frame
-        rfrm = np.argmin(fsum + rsum)
+            # > reference frame for SUVr composite frame
+            rfrm = np.argmin(fsum + rsum)
 
         niiref = nimpa.getnii(nii_frms[rfrm], output='all')
 
-        # > initialise target aligned SUVr image
-        niiim = np.zeros((len(nii_frms),) + niiref['shape'], dtype=np.float32)
-
-        # > copy in the target frame for SUVr composite
-        niiim[rfrm, ...] = niiref['im']
-
-        for ifrm in range(len(nii_frms)):
-            if ifrm == rfrm:
-                continue
-
-            # > resample images for alignment
-            frsmpl = nimpa.resample_spm(
-                nii_frms[rfrm],
-                nii_frms[ifrm],
-                S[rfrm][ifrm],
-                intrp=1.,
-                outpath=rsmpl_opth,
-                pickname='flo',
-                del_ref_uncmpr=True,
-                del_flo_uncmpr=True,
-                del_out_uncmpr=True,
-            )
-
-            niiim[ifrm, ...] = nimpa.getnii(frsmpl)
-
-        # > save aligned SUVr frames
-        nimpa.array2nii(
-            niiim, niiref['affine'], faligned, descrip='AmyPET: aligned SUVr frames',
-            trnsp=(niiref['transpose'].index(0), niiref['transpose'].index(1),
-                   niiref['transpose'].index(2)), flip=niiref['flip'])
+        # > initialise target aligned SUVr image (memory-mapped to disk,
+        # > so that only one frame at a time is held in memory); it is kept
+        # > in float32, the NIfTI output type, so that writing the stack
+        # > needs no in-memory conversion of the whole 4D image
+        fniiim = rsmpl_opth / 'SUVr_aligned_frames.dat'
+        niiim = np.memmap(fniiim, dtype=np.float32, mode='w+',
+                          shape=(len(nii_frms),) + niiref['shape'])
+
+        # > decompressed frames (to be removed at the end)
+        nii_frms_u = []
+        try:
+            # > copy in the target frame for SUVr composite
+            niiim[rfrm, ...] = niiref['im']
+
+            # > decompress the frames only once for all the resampling
+            # > (instead of for every resampling of a frame pair)
+            for fnii in nii_frms:
+                if fnii.suffix == '.gz':
+                    nii_frms_u.append(Path(nimpa.nii_ugzip(fnii, outpath=rsmpl_opth)))
+                else:
+                    nii_frms_u.append(fnii)
+
+            for ifrm in range(len(nii_frms)):
+                if ifrm == rfrm:
+                    continue
+
+                # > resample images for alignment; the (uncompressed) inputs
+                # > are copied by SPM resampling, so only the copies are removed
+                frsmpl = nimpa.resample_spm(
+                    nii_frms_u[rfrm],
+                    nii_frms_u[ifrm],
+                    S[rfrm][ifrm],
+                    intrp=1.,
+                    outpath=rsmpl_opth,
+                    pickname='flo',
+                    del_ref_uncmpr=True,
+                    del_flo_uncmpr=True,
+                    del_out_uncmpr=True,
+                )
+
+                niiim[ifrm, ...] = nimpa.getnii(frsmpl)
+                niiim.flush()
+
+            # > save aligned SUVr frames
+            nimpa.array2nii(
+                niiim, niiref['affine'], faligned,
+                descrip='AmyPET: aligned SUVr frames',
+                trnsp=(niiref['transpose'].index(0), niiref['transpose'].index(1),
+                       niiref['transpose'].index(2)), flip=niiref['flip'])
+
+        finally:
+            # > release and remove the memory-mapped frames, also on failure
+            del niiim
+            os.remove(fniiim)
+
+            # > remove the decompressed frames and any input copies left
+            # > by an interrupted resampling
+            for fnii, fniiu in zip(nii_frms, nii_frms_u):
+                if fniiu != fnii and fniiu.is_file():
+                    os.remove(fniiu)
+            for fcopy in rsmpl_opth.glob('*_copy.nii'):
+                os.remove(fcopy)
         # -----------------------------------------------
 
     return {'fpet': faligned, 'outpath': niidir, 'Metric': R, 'faff': S}
@@ -471,11 +618,14 @@ def native_proc(cl_dct, atlas='aal', res='1', outpath=None, refvoi_idx=None, ref
     # > get a probability mask for cerebellar GM
 
     if refvoi_idx is not None:
-        refmsk = np.zeros(petdct['im'].shape, dtype=np.float32)
-        for mi in refvoi_idx:
-            print(mi)
-            msk = atl_im == mi
-            refmsk += msk * gm_msk
+        # > look-up table of the atlas labels belonging to the reference VOI,
+        # > so that the atlas is traversed only once for all the labels
+        atl_lbl = np.clip(np.nan_to_num(atl_im), 0, None).astype(np.int64)
+        lut = np.zeros(atl_lbl.max() + 1, dtype=np.float32)
+        # > only the labels within the atlas range (the others match no voxel)
+        ridx = np.asarray(list(refvoi_idx), dtype=np.int64)
+        lut[ridx[(ridx >= 0) & (ridx < len(lut))]] = 1
+        refmsk = (lut[atl_lbl] * gm_msk).astype(np.float32)
 
     # > probability mask for chosen VOI
     if refvoi_name is not None:
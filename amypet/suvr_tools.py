@@ -1,12 +1,22 @@
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path, PurePath
 from subprocess import run
 
 import dcm2niix
+import nibabel as nib
 import numpy as np
 from matplotlib import pyplot as plt
 from niftypet import nimpa
+from scipy import ndimage
+
+from .utils import cpu_count
 
 logging.basicConfig(level=logging.INFO)
 nifti_ext = ('.nii', '.nii.gz')
@@ -14,44 +24,90 @@ dicom_ext = ('.DCM', '.dcm', '.img', '.IMG', '.ima', '.IMA')
 
 
 # ========================================================================================
-def r_trimup(fpet, fmri, outpath=None, store_img_intrmd=True):
+def r_trimup(fpet, fmri, outpath=None, store_img_intrmd=True, trim_cache=True):
     '''
     trim and upscale PET relative to MR T1w or its derivative;
-    derives the scale of upscaling/trimming using the image/voxel sizes
+    derives the scale of upscaling/trimming using the image/voxel sizes.
+    With `trim_cache`, an existing trimmed image of the same PET input
+    and scale is reused instead of trimming again.
     '''
 
+    # > only the headers are needed for the scale; avoid loading images
     if isinstance(fpet, (str, PurePath)):
-        petdct = nimpa.getnii(fpet, output='all')
+        pethdr = nib.load(str(fpet)).header
     elif isinstance(fpet, dict) and 'hdr' in fpet:
-        petdct = fpet
+        pethdr = fpet['hdr']
     else:
         raise ValueError('wrong PET input - accepted are path to image file or dictionary')
 
     if isinstance(fmri, (str, PurePath)):
-        mridct = nimpa.getnii(fmri, output='all')
+        mrihdr = nib.load(str(fmri)).header
     elif isinstance(fmri, dict) and 'hdr' in fmri:
-        mridct = fmri
+        mrihdr = fmri['hdr']
     else:
         raise ValueError('wrong MR input - accepted are path to image file or dictionary')
 
     # > get the voxel sizes
-    pet_szyx = petdct['hdr']['pixdim'][1:4]
-    mri_szyx = mridct['hdr']['pixdim'][1:4]
+    pet_szyx = np.asarray(pethdr['pixdim'][1:4])
+    mri_szyx = np.asarray(mrihdr['pixdim'][1:4])
 
     # > estimate the scale
     scale = np.abs(np.round(pet_szyx[::-1] / mri_szyx[::-1])).astype(np.int32)
 
+    # > trimming cache identified by the PET input file and the scale
+    # > (for a single frame, stored in one trimmed file)
+    fcache = None
+    if trim_cache and isinstance(fpet, (str, PurePath)) and (
+            pethdr['dim'][0] == 3 or pethdr['dim'][4] == 1):
+        fcache = Path(outpath or Path(fpet).parent) / 'trimcache_{}.json'.format(
+            _reg_key((fpet,), scale.tolist()))
+
+    if fcache is not None and fcache.is_file():
+        with open(fcache) as f:
+            ftrm = json.load(f)['ftrm']
+        # > the trimmed image must still be there with the upsampled voxel size
+        if os.path.isfile(ftrm) and np.allclose(
+                nib.load(ftrm).header['pixdim'][1:4], pet_szyx / scale[::-1], rtol=1e-3):
+            logging.info(f'using the cached trimmed PET: {ftrm}')
+            # > the same image array as output by `nimpa.imtrimup`, which stores
+            # > it with the y and z axes reversed (independent of the affine)
+            imtrm = np.asanyarray(nib.load(ftrm).dataobj).T[::-1, ::-1, :]
+            return {
+                'im': np.ascontiguousarray(imtrm), 'trmdir': Path(ftrm).parent, 'ftrm': ftrm,
+                'trim_scale': scale}
+
     # > trim the PET image for more accurate regional sampling
     ftrm = nimpa.imtrimup(fpet, scale=scale, store_img_intrmd=store_img_intrmd, outpath=outpath)
 
     # > trimmed folder
     trmdir = Path(ftrm['fimi'][0]).parent
 
+    if fcache is not None:
+        fcache.parent.mkdir(parents=True, exist_ok=True)
+        with open(fcache, 'w') as f:
+            json.dump({'ftrm': str(ftrm['fimi'][0])}, f)
+
     return {'im': ftrm['im'], 'trmdir': trmdir, 'ftrm': ftrm['fimi'][0], 'trim_scale': scale}
 
 
 # ========================================================================================
-def extract_vois(impet, imlabel, voi_dct, outpath=None, output_masks=False):
+def _reg_key(fpths, *params, nbytes=4 * 1024**2):
+    '''
+    Get the hash key identifying a registration by its input image files
+    `fpths` (their size and the first `nbytes` of each file, or the whole
+    file if `nbytes` is None) and any further registration parameters `params`.
+    '''
+    h = hashlib.blake2b(digest_size=8)
+    for fpth in fpths:
+        h.update(str(os.path.getsize(fpth)).encode())
+        with open(fpth, 'rb') as f:
+            h.update(f.read(nbytes))
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+# ========================================================================================
+def extract_vois(impet, imlabel, voi_dct, outpath=None, output_masks=False, atlas_mask=None):
     '''
     Extract VOI mean values from PET image `impet` using image labels `imlabel`.
     Both can be dictionaries, file paths or Numpy arrays.
@@ -63,9 +119,12 @@ def extract_vois(impet, imlabel, voi_dct, outpath=None, output_masks=False):
                     from T1w-based parcellation or an atlas.
         - voi_dct:  dictionary of VOIs, with entries of labels creating
                     composite volumes
-        - output_masks: if `True`, output Numpy VOI masks in the output
-                    dictionary
+        - output_masks: if `True`, output the VOI masks in the output
+                    dictionary as flat voxel indices (`roi_idx`) with
+                    the image shape (`roi_shape`); see `voi_mask()`
         - outpath:  if given as a folder path, the VOI masks will be saved
+        - atlas_mask: mask (dictionary, file path or Numpy array) confining
+                    the VOI sampling to its non-zero voxels, e.g., a GM mask
     '''
 
     # > assume none of the below are given
@@ -118,50 +177,121 @@ def extract_vois(impet, imlabel, voi_dct, outpath=None, output_masks=False):
         lbls = imlabel
 
     # > get rid of NaNs if any in the parcellation/label image
-    lbls[np.isnan(lbls)] = 0
+    if lbls.dtype.kind == 'f':
+        lbls[np.isnan(lbls)] = 0
+    # ----------------------------------------------
+
+    # ----------------------------------------------
+    # ATLAS MASK
+    if isinstance(atlas_mask, dict):
+        amsk = atlas_mask['im'] > 0
+    elif isinstance(atlas_mask, (str, PurePath)) and os.path.isfile(atlas_mask):
+        amsk = nimpa.getnii(atlas_mask) > 0
+    elif isinstance(atlas_mask, np.ndarray):
+        amsk = atlas_mask > 0
+    elif atlas_mask is None:
+        amsk = None
+    else:
+        raise ValueError('unrecognised atlas mask - accepted are dictionary, path to an existing'
+                         ' image file or Numpy array')
+    # ----------------------------------------------
+
+    # ----------------------------------------------
+    # > per-label voxel counts and emission sums from a single pass
+    # > over the images; the VOI values are then combined from these,
+    # > which also works for VOIs sharing the same labels
+    # > flat label indices starting from 0; small unsigned integer labels
+    # > are used as the indices directly, without a wider copy
+    lbl_flat = lbls.ravel()
+    if lbl_flat.dtype.kind == 'u' and lbl_flat.dtype.itemsize <= 2:
+        lbl_min = 0
+    else:
+        lbl_flat = lbl_flat.astype(np.int64)
+        lbl_min = lbl_flat.min()
+        lbl_flat -= lbl_min
+    nlbl = int(lbl_flat.max()) + 1
+
+    # > the atlas mask is applied once for all the VOIs
+    if amsk is not None:
+        lbl_smpl = lbl_flat[amsk.ravel()]
+        im_smpl = im.ravel()[amsk.ravel()]
+    else:
+        lbl_smpl = lbl_flat
+        im_smpl = im.ravel()
+
+    lbl_vxno = np.bincount(lbl_smpl, minlength=nlbl)
+    lbl_emsum = np.bincount(lbl_smpl, weights=im_smpl, minlength=nlbl)
     # ----------------------------------------------
 
     # ----------------------------------------------
     # > output dictionary
     out = {}
 
+    # > the masks are only needed when saved or output
+    save_masks = outpath is not None and not isinstance(imlabel, np.ndarray)
+
+    if save_masks or output_masks:
+        # > flat voxel indices grouped by label (with a single stable sort),
+        # > so that each VOI mask is joined from the groups of its labels
+        # > without passing over the whole label image for each VOI
+        lbl_order = np.argsort(lbl_smpl, kind='stable')
+        if amsk is not None:
+            lbl_order = np.flatnonzero(amsk)[lbl_order]
+        lbl_offs = np.concatenate(([0], np.cumsum(lbl_vxno)))
+
     logging.debug('Extracting volumes of interest (VOIs):')
     for k, voi in enumerate(voi_dct):
 
         logging.info(f'  VOI: {voi}')
+        logging.debug(f'   labels: {voi_dct[voi]}')
+
+        # > label indices of the VOI within the label counts
+        lidx = np.unique(voi_dct[voi]).astype(np.int64) - lbl_min
+        lidx = lidx[(lidx >= 0) & (lidx < nlbl)]
 
-        # > ROI mask
-        rmsk = np.zeros(lbls.shape, dtype=bool)
         # > number of voxels in the ROI
-        vxsum = 0
+        vxsum = np.sum(lbl_vxno[lidx])
         # > voxel emission sum
-        emsum = 0
+        emsum = np.sum(lbl_emsum[lidx])
 
-        for ri in voi_dct[voi]:
-            logging.debug(f'   label{ri}')
-            rmsk += np.equal(lbls, ri)
+        if save_masks or output_masks:
+            # > ROI voxel indices (sorted) joined from the VOI label groups
+            roi_idx = np.sort(
+                np.concatenate([lbl_order[lbl_offs[i]:lbl_offs[i + 1]] for i in lidx]
+                               + [np.zeros(0, dtype=np.intp)]))
 
-        if outpath is not None and not isinstance(imlabel, np.ndarray):
+        if save_masks:
+            rmsk = np.zeros(lbls.size, dtype=np.int8)
+            rmsk[roi_idx] = 1
             nimpa.create_dir(outpath)
             fvoi = Path(outpath) / (str(voi) + '_mask.nii.gz')
-            nimpa.array2nii(rmsk.astype(np.int8), affine, fvoi,
+            nimpa.array2nii(rmsk.reshape(lbls.shape), affine, fvoi,
                             trnsp=(trnsp.index(0), trnsp.index(1), trnsp.index(2)), flip=flip)
         else:
             fvoi = None
 
-        vxsum += np.sum(rmsk)
-        emsum += np.sum(im[rmsk].astype(np.float64))
-
         out[voi] = {'vox_no': vxsum, 'sum': emsum, 'avg': emsum / vxsum, 'fvoi': fvoi}
 
         if output_masks:
-            out[voi]['roimsk'] = rmsk
+            out[voi]['roi_idx'] = roi_idx
+            out[voi]['roi_shape'] = lbls.shape
 
     # ----------------------------------------------
 
     return out
 
 
+# ========================================================================================
+def voi_mask(voi):
+    '''
+    Get the boolean VOI mask from the VOI output of `extract_vois`
+    (requires the VOI masks to be output, i.e., `output_masks=True`).
+    '''
+    rmsk = np.zeros(np.prod(voi['roi_shape']), dtype=bool)
+    rmsk[voi['roi_idx']] = True
+    return rmsk.reshape(voi['roi_shape'])
+
+
 # ========================================================================================
 def preproc_suvr(pet_path, frames=None, outpath=None, fname=None):
     ''' Prepare the PET image for SUVr analysis.
@@ -222,11 +352,9 @@ def preproc_suvr(pet_path, frames=None, outpath=None, fname=None):
         else:
             fpet_nii = fpet_nii[0]
 
-    # > read the dynamic image
-    imdct = nimpa.getnii(fpet_nii, output='all')
-
-    # > number of dynamic frames
-    nfrm = imdct['hdr']['dim'][4]
+    # > number of dimensions and of dynamic frames (from the header only)
+    pethdr = nib.load(str(fpet_nii)).header
+    ndim, nfrm = pethdr['dim'][0], pethdr['dim'][4]
 
     # > ensure that the frames exist in part of full dynamic image data
     if frames and nfrm < max(frames):
@@ -241,12 +369,31 @@ def preproc_suvr(pet_path, frames=None, outpath=None, fname=None):
     fstat = petout / fname
 
     # > check if the static (for SUVr) file already exists
-    if not fstat.is_file():
-
-        if nfrm > 1:
-            imstat = np.sum(imdct['im'][frames, ...], axis=0)
+    if not fstat.is_file() and ndim == 3 and str(fpet_nii).endswith(nifti_ext[1]):
+        # > 3D image which is already the static image (a 4D image with
+        # > a single frame is still saved as a 3D image below)
+        shutil.copyfile(fpet_nii, fstat)
+
+        logging.info(f'Copied SUVr file image to: {fstat}')
+
+    elif not fstat.is_file():
+
+        # > read the dynamic image
+        imdct = nimpa.getnii(fpet_nii, output='all')
+
+        frames = np.asarray(frames)
+        if nfrm > 1 and frames.size and np.all(np.diff(frames) == 1):
+            # > contiguous frames: sum over a view of the dynamic image
+            imstat = np.sum(imdct['im'][frames[0]:frames[-1] + 1], axis=0, dtype=np.float32)
+        elif nfrm > 1:
+            # > accumulate the selected frames in place (no copy of the frames)
+            imstat = np.zeros(imdct['im'].shape[1:], dtype=np.float32)
+            for fi in frames:
+                np.add(imstat, imdct['im'][fi], out=imstat, casting='unsafe')
+        elif imdct['im'].ndim > 3:
+            imstat = imdct['im'][0]
         else:
-            imstat = np.squeeze(imdct['im'])
+            imstat = imdct['im']
 
         nimpa.array2nii(
             imstat, imdct['affine'], fstat,
@@ -259,6 +406,32 @@ def preproc_suvr(pet_path, frames=None, outpath=None, fname=None):
     return {'fpet_nii': fpet_nii, 'fstat': fstat}
 
 
+# ========================================================================================
+def _resample_labels(fref, flbl, faff, fout):
+    '''
+    Resample the label image `flbl` to the space of the reference image
+    `fref` using the affine `faff` (nearest neighbour), saving it to `fout`.
+    The uncompressed intermediate images can be kept in a (RAM-backed)
+    temporary folder given by the `AMYPET_TMP` environment variable.
+    '''
+    fout = Path(fout)
+
+    if not os.environ.get('AMYPET_TMP'):
+        return nimpa.resample_spm(fref, flbl, faff, outpath=fout.parent, intrp=0.,
+                                  fimout=fout.name, del_ref_uncmpr=True, del_flo_uncmpr=True,
+                                  del_out_uncmpr=True)
+
+    # > resampled within the temporary folder and then moved to the output
+    # > (possibly across file systems); the folder is removed also on failure
+    with tempfile.TemporaryDirectory(dir=os.environ['AMYPET_TMP']) as rsmpl_tmp:
+        frsmpl = nimpa.resample_spm(fref, flbl, faff, outpath=rsmpl_tmp, intrp=0.,
+                                    fimout=fout.name, del_ref_uncmpr=True,
+                                    del_flo_uncmpr=True, del_out_uncmpr=True)
+        shutil.move(frsmpl, fout)
+
+    return str(fout)
+
+
 # ========================================================================================
 # Extract VOI values for SUVr analysis (main function)
 # ========================================================================================
@@ -266,7 +439,8 @@ def preproc_suvr(pet_path, frames=None, outpath=None, fname=None):
 
 def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None, fname=None,
                 t1_bias_corr=True, outpath=None, output_masks=True, save_voi_masks=False,
-                qc_plot=True, reg_fwhm_pet=0, reg_fwhm_mri=0, reg_costfun='nmi', reg_fresh=True):
+                qc_plot=True, reg_fwhm_pet=0, reg_fwhm_mri=0, reg_costfun='nmi', reg_fresh=True,
+                reg_cache=True):
     ''' Process PET image for VOI extraction using MR-based parcellations.
         The T1w image and the labels which are based on the image must be
         in the same image space.
@@ -284,8 +458,10 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
         - t1_bias_corr: it True, performs bias field correction of the T1w image
         - outpath:  folder path to the output images, including intermediate
                     images
-        - output_masks: if True, output VOI sampling masks in the output
-                    dictionary
+        - output_masks: if True, output the VOI sampling masks in the output
+                    dictionary as flat voxel indices (`roi_idx`) with the
+                    image shape (`roi_shape`) for each VOI; the boolean mask
+                    volume of a VOI is obtained with `voi_mask()`
         - save_voi_masks: if True, saves all the VOI masks to the `masks` folder
         - qc_plot:  plots the PET images and overlay sampling, and saves it to
                     a PNG file; requires `output_masks` to be True.
@@ -294,6 +470,9 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
         - reg_costfun: cost function used in image registration
         - reg_fresh:runs fresh registration if True, otherwise uses an existing
                     one if found.
+        - reg_cache:if True, reuses the registration of a previous run with
+                    identical input images and registration parameters,
+                    even if `reg_fresh` is True.
 
     '''
 
@@ -318,8 +497,19 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
     # > if dictionary is not given, the VOI values will be calculated for each unique
     # > VOI in the label/parcellation image
     if voi_dct is None:
-        lbl = nimpa.getnii(lblpth)
-        voi_dct = {int(lab): [int(lab)] for lab in np.unique(lbl)}
+        # > find the labels with histogram passes (no sorting) over slabs
+        # > of the (memory-mapped) label image, without loading it whole;
+        # > the file is kept open, so that the slabs of a compressed image
+        # > are decompressed in one forward pass (not from the start each time)
+        dobj = nib.load(str(lblpth), mmap=True, keep_file_open=True).dataobj
+        labs = set()
+        for z0 in range(0, dobj.shape[2], 32):
+            lbl = np.nan_to_num(np.asarray(dobj[:, :, z0:z0 + 32])).ravel().astype(np.int64)
+            lbl_min = lbl.min()
+            lbl -= lbl_min
+            labs.update((np.flatnonzero(np.bincount(lbl)) + lbl_min).tolist())
+        del dobj
+        voi_dct = {lab: [lab] for lab in sorted(labs)}
 
     if ref_voi is not None and not all([r in voi_dct for r in ref_voi]):
         raise ValueError('Not all VOIs listed as reference are in the VOI definition dictionary.')
@@ -357,7 +547,25 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
     fplbl = trmdir / '{}_Parcellation_in-upsampled-PET.nii.gz'.format(
         suvr_preproc['fstat'].name.split('.nii')[0])
 
-    if not fplbl.is_file() or reg_fresh:
+    # > registration cache identified by the input images and parameters
+    fcache = trmdir / 'regcache_{}.json'.format(
+        _reg_key((suvr_preproc['fstat'], t1wpth, lblpth), out['trim_scale'].tolist(),
+                 t1_bias_corr, reg_fwhm_pet, reg_fwhm_mri, reg_costfun))
+
+    # > the cached registration is valid only if the parcellation file in PET
+    # > space is still the one written with it (the file is shared by all
+    # > the registration parameters and may have been overwritten since)
+    reg_cached = False
+    if reg_cache and fcache.is_file() and fplbl.is_file():
+        with open(fcache) as f:
+            regc = json.load(f)
+        reg_cached = (regc['flbl'] == str(fplbl)
+                      and regc.get('flbl_key') == _reg_key((fplbl,), nbytes=None))
+
+    if reg_cached:
+        logging.info(f'using the cached registration: {fcache}')
+
+    elif not fplbl.is_file() or reg_fresh:
 
         logging.info(f'registration with smoothing of {reg_fwhm_pet}, {reg_fwhm_mri} mm'
                      ' for reference and floating images respectively')
@@ -367,17 +575,13 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
                                   fcomment='', outpath=trmdir, visual=0, save_arr=False,
                                   del_uncmpr=True)
 
-        flbl_pet = nimpa.resample_spm(
-            trmout['ftrm'],
-            lblpth,
-            spm_res['faff'],
-            outpath=trmdir,
-            intrp=0.,
-            fimout=fplbl,
-            del_ref_uncmpr=True,
-            del_flo_uncmpr=True,
-            del_out_uncmpr=True,
-        )
+        _resample_labels(trmout['ftrm'], lblpth, spm_res['faff'], fplbl)
+
+        if reg_cache:
+            with open(fcache, 'w') as f:
+                json.dump({
+                    'faff': str(spm_res['faff']), 'flbl': str(fplbl),
+                    'flbl_key': _reg_key((fplbl,), nbytes=None)}, f)
 
     out['flbl'] = fplbl
     # > - - - - - - - - - - - - - - - - - - - - - - - -
@@ -385,6 +589,16 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
     # > get the label image in PET space
     plbl_dct = nimpa.getnii(fplbl, output='all')
 
+    # > the resampled labels (nearest neighbour) are integer valued; store them
+    # > as 16-bit unsigned integers when they fit, to halve the label image
+    lbls = plbl_dct['im']
+    if lbls.dtype.kind == 'f':
+        lbls[np.isnan(lbls)] = 0
+    if lbls.size and lbls.min() >= 0 and lbls.max() <= np.iinfo(np.uint16).max and (
+            lbls.dtype.kind in 'iu' or all(np.array_equal(z, np.round(z)) for z in lbls)):
+        plbl_dct['im'] = lbls.astype(np.uint16, copy=False)
+    del lbls
+
     # > get the sampling output
     if save_voi_masks:
         mask_dir = trmdir / 'masks'
@@ -399,6 +613,13 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
 
         suvr = {}
 
+        # > the static trimmed image with its own geometry, read once for
+        # > all the reference regions
+        imsuvr = nimpa.getnii(out['ftrm'], output='all')
+
+        # > SUVr image buffer shared by all the reference regions
+        suvr_buf = np.empty(imsuvr['shape'], dtype=np.float32)
+
         suvrtxt = ' '
         for rvoi in ref_voi:
             ref = voival[rvoi]['avg']
@@ -406,13 +627,11 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
             for voi in voi_dct:
                 suvr[rvoi][voi] = voival[voi]['avg'] / ref
 
-            # > get the static trimmed image:
-            imsuvr = nimpa.getnii(out['ftrm'], output='all')
-
             fsuvr = trmdir / 'SUVr_ref-{}_{}'.format(rvoi, suvr_preproc['fstat'].name)
             # > save SUVr image
+            np.divide(imsuvr['im'], np.float32(ref), out=suvr_buf, casting='unsafe')
             nimpa.array2nii(
-                imsuvr['im'] / ref, imsuvr['affine'], fsuvr,
+                suvr_buf, imsuvr['affine'], fsuvr,
                 trnsp=(imsuvr['transpose'].index(0), imsuvr['transpose'].index(1),
                        imsuvr['transpose'].index(2)), flip=imsuvr['flip'])
 
@@ -422,6 +641,7 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
                 suvrval = suvr[rvoi]['suvr']
                 suvrtxt += f'$SUVR_\\mathrm{{{rvoi}}}=${suvrval:.3f}; '
 
+        del suvr_buf, imsuvr
         out['suvr'] = suvr
 
     out['vois'] = voival
@@ -429,12 +649,12 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
     # -----------------------------------------
     # > QC plot
     if qc_plot and output_masks:
-        showpet = nimpa.imsmooth(trmout['im'].astype(np.float32), voxsize=plbl_dct['voxsize'],
-                                 fwhm=3.)
-
         def axrange(prf, thrshld, parts):
-            zs = next(x for x, val in enumerate(prf) if val > thrshld)
-            ze = len(prf) - next(x for x, val in enumerate(prf[::-1]) if val > thrshld)
+            abv = np.asarray(prf) > thrshld
+            if not abv.any():
+                raise StopIteration('no profile values above the threshold')
+            zs = int(np.argmax(abv))
+            ze = len(prf) - int(np.argmax(abv[::-1]))
             # divide the range in parts
             p = int((ze-zs) / parts)
             zn = []
@@ -442,47 +662,136 @@ def voi_process(petpth, lblpth, t1wpth, voi_dct=None, ref_voi=None, frames=None,
                 zn.append(zs + k*p)
             return zn
 
+        # > the mask profiles are obtained directly from the flat voxel indices
+        # > of the masks rather than from reductions of the mask volumes
+        nz, ny, nx = voival['neocx']['roi_shape']
+
         # z-profile
         zn = []
         thrshld = 100
-        zprf = np.sum(voival['neocx']['roimsk'], axis=(1, 2))
+        zprf = np.bincount(voival['neocx']['roi_idx'] // (ny*nx), minlength=nz)
         zn += axrange(zprf, thrshld, 3)
 
-        zprf = np.sum(voival['cblgm']['roimsk'], axis=(1, 2))
+        zprf = np.bincount(voival['cblgm']['roi_idx'] // (ny*nx), minlength=nz)
         zn += axrange(zprf, thrshld, 2)
 
-        mskshow = voival['neocx']['roimsk'] + voival['cblgm']['roimsk']
+        # > union (boolean OR) of the two masks built in a single boolean volume
+        mskshow = np.zeros(nz * ny * nx, dtype=bool)
+        mskshow[voival['neocx']['roi_idx']] = True
+        mskshow[voival['cblgm']['roi_idx']] = True
+        mskshow = mskshow.reshape(nz, ny, nx)
 
         xn = []
-        xprf = np.sum(mskshow, axis=(0, 1))
+        xprf = np.bincount(
+            np.union1d(voival['neocx']['roi_idx'], voival['cblgm']['roi_idx']) % nx, minlength=nx)
         xn += axrange(xprf, thrshld, 4)
 
+        # > Gaussian smoothing (FWHM of 3 mm) applied only to the displayed slices
+        sigma = 3. / (2 * np.sqrt(2 * np.log(2))) / np.asarray(plbl_dct['voxsize'])
+
+        # > subsampling step limiting the displayed slices to ~512 pixels
+        step = max(1, max(trmout['im'].shape) // 512)
+
+        # > y position of the SUVr text below the top row of slices
+        ytxt = -(-trmout['im'].shape[1] // step) + 10
+
+        # > smoothed transaxial and sagittal slices with their mask overlays
+        impet = [
+            ndimage.gaussian_filter(trmout['im'][zidx, ...].astype(np.float32, copy=False),
+                                    sigma=sigma[1:])[::step, ::step] for zidx in zn]
+        impet += [
+            ndimage.gaussian_filter(trmout['im'][..., xidx].astype(np.float32, copy=False),
+                                    sigma=sigma[:2])[::step, ::step] for xidx in xn]
+        # > copies, so that the figure does not keep the whole mask volume
+        msk = [mskshow[zidx, ::step, ::step].copy() for zidx in zn]
+        msk += [mskshow[::step, ::step, xidx].copy() for xidx in xn]
+
+        # > common display maximum for all the panels, robust to hot voxels
+        vmax = 0.9 * float(np.percentile(np.concatenate([i.ravel() for i in impet]), 99.5))
+
         fig, ax = plt.subplots(2, 3, figsize=(16, 16))
 
-        for ai, zidx in enumerate(zn):
-            msk = mskshow[zidx, ...]
-            impet = showpet[zidx, ...]
-            ax[0][ai].imshow(impet, cmap='magma', vmax=0.9 * impet.max())
-            ax[0][ai].imshow(msk, cmap='gray_r', alpha=0.25)
-            ax[0][ai].xaxis.set_visible(False)
-            ax[0][ai].yaxis.set_visible(False)
+        for ai, (sim, smsk) in enumerate(zip(impet, msk)):
+            axi = ax[ai // 3][ai % 3]
+            axi.imshow(sim, cmap='magma', vmax=vmax)
+            axi.imshow(smsk, cmap='gray_r', alpha=0.25)
+            axi.xaxis.set_visible(False)
+            axi.yaxis.set_visible(False)
 
-        for ai, xidx in enumerate(xn):
-            msk = mskshow[..., xidx]
-            impet = showpet[..., xidx]
-            ax[1][ai].imshow(impet, cmap='magma', vmax=0.9 * impet.max())
-            ax[1][ai].imshow(msk, cmap='gray_r', alpha=0.25)
-            ax[1][ai].xaxis.set_visible(False)
-            ax[1][ai].yaxis.set_visible(False)
+        # > the slices are now held by the figure; release the image volumes
+        # > before rendering to limit the peak memory
+        del mskshow, msk, impet, trmout, plbl_dct
 
-        ax[0, 1].text(0, trmout['im'].shape[1] + 10, suvrtxt, fontsize=12)
+        ax[0, 1].text(0, ytxt, suvrtxt, fontsize=12)
 
         plt.tight_layout()
 
         fqc = trmdir / f'QC_{petpth.name}_Parcellation-over-upsampled-PET.png'
-        plt.savefig(fqc, dpi=300)
+        plt.savefig(fqc, dpi=150)
         plt.close('all')
         out['fqc'] = fqc
     # -----------------------------------------
 
     return out
+
+
+# ========================================================================================
+def voi_process_batch(pet_list, lbl_list, t1w_list, outpath_list=None, n_jobs=None, **kwargs):
+    ''' Run `voi_process` for a number of subjects in parallel processes.
+        The lists of PET, label and T1w images (and output paths) are matched
+        by their order; any other arguments of `voi_process` are passed as
+        keywords and are the same for all subjects.
+
+        Arguments:
+        - pet_list: paths to the PET NIfTI images
+        - lbl_list: paths to the label NIfTI images (parcellations)
+        - t1w_list: paths to the T1w MRI NIfTI images for registration
+        - outpath_list: output folders, one for each subject; by default
+                    the outputs go next to each PET image
+        - n_jobs:   number of parallel processes; by default the number
+                    of CPU cores
+        - kwargs:   keyword arguments of `voi_process` other than `outpath`
+
+        Returns the list of `voi_process` outputs in the input order.
+    '''
+
+    if 'outpath' in kwargs:
+        raise ValueError('the output paths must be given per subject in `outpath_list`')
+
+    if outpath_list is None:
+        outpath_list = [None] * len(pet_list)
+
+    if not len(pet_list) == len(lbl_list) == len(t1w_list) == len(outpath_list):
+        raise ValueError(
+            'the lists of PET, label, T1w images and output paths must be of the same length')
+
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    n_jobs = max(1, min(n_jobs, len(pet_list)))
+
+    sbj_inputs = list(zip(pet_list, lbl_list, t1w_list, outpath_list))
+
+    if n_jobs == 1:
+        return [voi_process(fp, fl, ft, outpath=op, **kwargs) for fp, fl, ft, op in sbj_inputs]
+
+    # > single-threaded numerical libraries in each worker to avoid
+    # > oversubscription of the cores; the fresh (spawned) worker
+    # > processes inherit the environment at their start
+    nthrd_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+    env0 = {k: os.environ.get(k) for k in nthrd_vars}
+    os.environ.update({k: '1' for k in nthrd_vars})
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(voi_process, fp, fl, ft, outpath=op, **kwargs)
+                for fp, fl, ft, op in sbj_inputs]
+            out = [f.result() for f in futures]
+    finally:
+        for k, v in env0.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+    return out
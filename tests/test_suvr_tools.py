@@ -0,0 +1,218 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+suvr_tools = pytest.importorskip("amypet.suvr_tools")
+
+
+def extract_vois_ref(impet, imlabel, voi_dct, atlas_mask=None):
+    """reference VOI sampling with one `np.equal` pass per label"""
+    out = {}
+    for voi in voi_dct:
+        rmsk = np.zeros(imlabel.shape, dtype=bool)
+        for ri in voi_dct[voi]:
+            rmsk += np.equal(imlabel, ri)
+        if atlas_mask is not None:
+            rmsk &= atlas_mask > 0
+        out[voi] = {'vox_no': np.sum(rmsk), 'sum': np.sum(impet[rmsk]), 'msk': rmsk}
+    return out
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(7)
+    # > labels including negative and unused values
+    lbl = rng.integers(-4, 24, size=(14, 15, 16)).astype(np.float32)
+    pet = rng.random(lbl.shape).astype(np.float32)
+    amsk = (rng.random(lbl.shape) > 0.4).astype(np.float32)
+    # > shared labels between VOIs, negative labels and an empty VOI
+    voi_dct = {'a': [1, 2, 3], 'b': [3, 4], 'neg': [-4, -1], 'bg': [0], 'empty': [99]}
+    return pet, lbl, amsk, voi_dct
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.int32, np.uint16])
+@pytest.mark.parametrize("use_atlas", [False, True])
+def test_extract_vois(images, dtype, use_atlas):
+    pet, lbl, amsk, voi_dct = images
+    if dtype == np.uint16:
+        # > the fast path for small unsigned labels
+        lbl = np.clip(lbl, 0, None)
+    lbl = lbl.astype(dtype)
+    atlas_mask = amsk if use_atlas else None
+
+    ref = extract_vois_ref(pet, lbl, voi_dct, atlas_mask=atlas_mask)
+    with np.errstate(invalid='ignore'):
+        out = suvr_tools.extract_vois(pet, lbl.copy(), voi_dct, output_masks=True,
+                                      atlas_mask=atlas_mask)
+
+    for voi in voi_dct:
+        assert out[voi]['vox_no'] == ref[voi]['vox_no']
+        assert out[voi]['sum'] == pytest.approx(ref[voi]['sum'], rel=1e-5)
+        assert np.array_equal(suvr_tools.voi_mask(out[voi]), ref[voi]['msk'])
+        if ref[voi]['vox_no']:
+            assert out[voi]['avg'] == pytest.approx(ref[voi]['sum'] / ref[voi]['vox_no'],
+                                                    rel=1e-5)
+        else:
+            assert np.isnan(out[voi]['avg'])
+
+
+def test_extract_vois_atlas_mask_missing(images, tmp_path):
+    pet, lbl, _, voi_dct = images
+    with pytest.raises(ValueError):
+        suvr_tools.extract_vois(pet, lbl, voi_dct, atlas_mask=tmp_path / "missing.nii.gz")
+
+
+def test_voi_mask(images):
+    pet, lbl, _, voi_dct = images
+    out = suvr_tools.extract_vois(pet, lbl, {'a': voi_dct['a']}, output_masks=True)
+    msk = suvr_tools.voi_mask(out['a'])
+    assert msk.dtype == bool
+    assert msk.shape == lbl.shape
+    assert msk.sum() == out['a']['vox_no']
+
+
+def stub_resample_spm(imref, imflo, M, outpath="", fimout="", **kwargs):
+    """stand-in for SPM resampling, writing the same files at the same places"""
+    Path(outpath, Path(imflo).name.split('.nii')[0] + '_copy.nii').write_bytes(b'')
+    fout = Path(outpath) / fimout
+    fout.write_bytes(b'labels')
+    return str(fout)
+
+
+def test_resample_labels_tmp(tmp_path, monkeypatch):
+    tmpdir = tmp_path / "tmp"
+    tmpdir.mkdir()
+    fout = tmp_path / "trimmed" / "plbl.nii.gz"
+    fout.parent.mkdir()
+    monkeypatch.setenv("AMYPET_TMP", str(tmpdir))
+    monkeypatch.setattr(suvr_tools.nimpa, "resample_spm", stub_resample_spm)
+
+    assert Path(suvr_tools._resample_labels("ref.nii.gz", "lbl.nii.gz", "aff.txt",
+                                            fout)) == fout
+    assert fout.read_bytes() == b'labels'
+    # > nothing left in the temporary folder nor next to the output
+    assert not list(tmpdir.iterdir())
+    assert list(fout.parent.iterdir()) == [fout]
+
+
+def test_resample_labels_tmp_failure(tmp_path, monkeypatch):
+    tmpdir = tmp_path / "tmp"
+    tmpdir.mkdir()
+
+    def failing_resample_spm(*args, **kwargs):
+        stub_resample_spm(*args, **kwargs)
+        raise RuntimeError("resampling failed")
+
+    monkeypatch.setenv("AMYPET_TMP", str(tmpdir))
+    monkeypatch.setattr(suvr_tools.nimpa, "resample_spm", failing_resample_spm)
+
+    with pytest.raises(RuntimeError):
+        suvr_tools._resample_labels("ref.nii.gz", "lbl.nii.gz", "aff.txt",
+                                    tmp_path / "plbl.nii.gz")
+    assert not list(tmpdir.iterdir())
+
+
+def test_resample_labels_no_tmp(tmp_path, monkeypatch):
+    fout = tmp_path / "plbl.nii.gz"
+    monkeypatch.delenv("AMYPET_TMP", raising=False)
+    monkeypatch.setattr(suvr_tools.nimpa, "resample_spm", stub_resample_spm)
+
+    assert Path(suvr_tools._resample_labels("ref.nii.gz", "lbl.nii.gz", "aff.txt",
+                                            fout)) == fout
+    assert fout.read_bytes() == b'labels'
+
+
+# > nimpa uses the deprecated `scipy.ndimage.interpolation` namespace
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+@pytest.mark.parametrize("pet_diag", [(-2, 2, 2), (2, 2, 2), (-2, -2, 2)])
+def test_r_trimup_cached(tmp_path, pet_diag):
+    nib = pytest.importorskip("nibabel")
+    rng = np.random.default_rng(3)
+    # > shape large enough for the trimming (to multiples of 64 voxels)
+    im = np.zeros((48, 50, 44), dtype=np.float32)
+    im[12:34, 15:37, 10:36] = rng.random((22, 22, 26)) + 1
+    fpet = tmp_path / "pet.nii.gz"
+    nib.save(nib.Nifti1Image(im, np.diag(pet_diag + (1,))), str(fpet))
+    fmri = tmp_path / "mri.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((96, 100, 88), dtype=np.float32), np.eye(4)), str(fmri))
+
+    trm0 = suvr_tools.r_trimup(fpet, fmri, outpath=tmp_path)
+    assert list(tmp_path.glob("trimcache_*.json"))
+    trm1 = suvr_tools.r_trimup(fpet, fmri, outpath=tmp_path)
+
+    assert trm1['ftrm'] == trm0['ftrm']
+    assert np.array_equal(trm1['trim_scale'], trm0['trim_scale'])
+    assert np.array_equal(trm1['im'], trm0['im'])
+
+
+@pytest.fixture
+def dynamic_nii(tmp_path):
+    nib = pytest.importorskip("nibabel")
+    rng = np.random.default_rng(5)
+    im = rng.random((10, 11, 12, 5)).astype(np.float32)
+    fnii = tmp_path / "dyn.nii.gz"
+    nib.save(nib.Nifti1Image(im, np.diag([-2, 2, 2, 1])), str(fnii))
+    return fnii
+
+
+@pytest.mark.parametrize("frames", [[1, 2, 3], [0, 2, 4], None])
+def test_preproc_suvr_frames(dynamic_nii, tmp_path, frames):
+    out = suvr_tools.preproc_suvr(dynamic_nii, frames=frames, outpath=tmp_path / "suvr")
+    imdyn = suvr_tools.nimpa.getnii(dynamic_nii)
+    expected = np.sum(imdyn[range(imdyn.shape[0]) if frames is None else frames], axis=0)
+    imstat = suvr_tools.nimpa.getnii(out['fstat'])
+    assert imstat.shape == imdyn.shape[1:]
+    assert np.allclose(imstat, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("shape", [(10, 11, 12), (10, 11, 12, 1)])
+def test_preproc_suvr_single_frame(tmp_path, shape):
+    nib = pytest.importorskip("nibabel")
+    im = np.random.default_rng(6).random(shape).astype(np.float32)
+    fnii = tmp_path / "static.nii.gz"
+    nib.save(nib.Nifti1Image(im, np.diag([-2, 2, 2, 1])), str(fnii))
+
+    out = suvr_tools.preproc_suvr(fnii, outpath=tmp_path / "suvr")
+    # > the static image is always 3D, also for a single frame 4D input
+    assert nib.load(str(out['fstat'])).shape == shape[:3]
+    assert np.array_equal(suvr_tools.nimpa.getnii(out['fstat']),
+                          suvr_tools.nimpa.getnii(fnii))
+    if len(shape) == 3:
+        # > copied as it is
+        assert out['fstat'].read_bytes() == fnii.read_bytes()
+
+
+@pytest.mark.parametrize("t_inj", [
+    datetime(2021, 3, 4, 10, 0, 0, 250000),
+    datetime(2021, 3, 3, 23, 10, 30, 750000)]) # across midnight
+def test_explore_input_timings(tmp_path, monkeypatch, t_inj):
+    preproc = pytest.importorskip("amypet.preproc")
+
+    # > four 5-minute frames of a static florbetaben acquisition from 90 minutes
+    t_acq0 = t_inj + timedelta(minutes=90, seconds=7)
+    srs = {}
+    for i in range(4):
+        t_acq = t_acq0 + timedelta(seconds=300 * i)
+        srs[f'frm{i}'] = {
+            'tacq': t_acq.strftime('%H%M%S'), 'dstudy': t_acq.strftime('%Y%m%d'),
+            'radio_start_time': t_inj, 'frm_dur': timedelta(seconds=300),
+            'tracer': 'Florbetaben', 'series': 'PET static',
+            'files': [tmp_path / f'frm{i}' / 'im.dcm']}
+
+    monkeypatch.setattr(preproc.nimpa, "dcmsort", lambda *args, **kwargs: srs)
+    indir = tmp_path / "input"
+    indir.mkdir()
+    out = preproc.explore_input(indir, outpath=tmp_path / "out", nii_convert=False)
+
+    # > reference timings as whole seconds of the time differences
+    ref = []
+    for k in srs:
+        t0 = datetime.strptime(srs[k]['dstudy'] + srs[k]['tacq'], '%Y%m%d%H%M%S')
+        ref.append(((t0 - t_inj).seconds, (t0 + srs[k]['frm_dur'] - t_inj).seconds))
+
+    descr = out['descr'][0]
+    assert descr['acq'] == ['static', 'suvr']
+    assert descr['timings'] == ref
+    assert descr['frms'] == list(srs)[descr['idxs'][0]:descr['idxs'][1] + 1]